@@ -1,9 +1,19 @@
 # front-engagement-bot/pages/2_Settings_Editor.py
 import streamlit as st
+import pandas as pd
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+import orjson
+import gzip
+import itertools
+import math
 import time
+import sys
+import threading
 import logging
+from functools import lru_cache
 # OrderedDict is not strictly needed if Python 3.7+ and API handles standard dict order for JSON
 # from collections import OrderedDict 
 
@@ -11,28 +21,94 @@ import logging
 try:
     import yaml as pyyaml
     PYYAML_AVAILABLE = True
+    try: from yaml import CSafeLoader as _YAML_LOADER, CSafeDumper as _YAML_DUMPER # libyaml C backend
+    except ImportError: from yaml import SafeLoader as _YAML_LOADER, SafeDumper as _YAML_DUMPER
 except ImportError:
     PYYAML_AVAILABLE = False
     logging.warning("PyYAML not installed. Cannot edit YAML fields like 'session_types'.")
 
+# Try importing ijson for streaming large settings responses
+try:
+    import ijson
+    IJSON_AVAILABLE = True
+except ImportError:
+    IJSON_AVAILABLE = False
+JSON_DECODE_ERRORS = (orjson.JSONDecodeError, ijson.JSONError) if IJSON_AVAILABLE else (orjson.JSONDecodeError,)
+
 # --- Configuration ---
 BOT_API_URL = st.secrets.get("BOT_API_URL", None)
 API_KEY = st.secrets.get("BOT_API_KEY", None)
 HEADERS = {'X-API-Key': API_KEY} if API_KEY else {}
+STREAM_PARSE_MIN_BYTES = 256 * 1024 # Settings responses at least this big are stream-parsed with ijson
+GZIP_UPLOADS = bool(st.secrets.get("BOT_API_GZIP_UPLOADS", False)) # Off unless the backend is known to accept gzip bodies
+GZIP_MIN_BYTES = 1024 # With GZIP_UPLOADS on, settings payloads at least this big are uploaded gzip-compressed
+SETTINGS_FRESH_TTL = 30 # Seconds loaded settings are shown without revalidating
+SETTINGS_STALE_TTL = 300 # Seconds stale settings are still shown while refreshing in the background
+# Select-style string settings checked in the grid: key -> (options, option -> index for O(1) membership)
+_LOG_LEVELS = ["debug", "info", "warning", "error", "critical"]
+_OPTIONS = {
+    'mode': (["prod", "dev"], {"prod": 0, "dev": 1}),
+    'log_level': (_LOG_LEVELS, {level: i for i, level in enumerate(_LOG_LEVELS)}),
+}
 
 # --- Helper Functions ---
 
-@st.cache_data(ttl=30) # Cache settings for 30 seconds
-def fetch_settings_data_from_api():
-    """Fetches the settings data from the backend API."""
+@st.cache_resource # Kept separate from cache_data so clearing the settings cache keeps the warm connection pool
+def get_session():
+    """Returns a shared requests.Session so settings fetches/saves reuse keep-alive connections."""
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    # raise_on_status=False: once retries run out, hand back the last response so raise_for_status() reports the backend error
+    retries = Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=retries)
+    session.mount(f"{BOT_API_URL.split('://')[0]}://" if BOT_API_URL else "https://", adapter)
+    return session
+
+@st.cache_resource # Process-wide so background refresh threads (which have no session_state) can use it too
+def get_settings_validator_cache():
+    """Holds the last settings payload and its ETag for conditional GETs."""
+    return {'lock': threading.Lock(), 'etag': None, 'payload': None}
+
+_ORJSON_INT_MIN, _ORJSON_INT_MAX = -2**63, 2**64 - 1 # orjson parses integers outside this range as floats
+
+def _orjson_compatible_numbers(events):
+    """Maps ijson number events to what orjson.loads would produce, so both parse paths load the same settings.
+    (ijson's yajl2_c backend overflows above int64 with use_float=True, so numbers are converted here instead.)"""
+    for prefix, event, value in events:
+        if event == 'number' and (type(value) is not int or not _ORJSON_INT_MIN <= value <= _ORJSON_INT_MAX):
+            value = float(value) # Decimal fractions and out-of-range integers become floats, as in orjson
+        yield prefix, event, value
+
+def _request_settings_from_api():
+    """Fetches the settings data from the backend API (uncached, safe to call from a background thread)."""
     if not BOT_API_URL: return None, "BOT_API_URL secret is not configured."
     api_endpoint = f"{BOT_API_URL}/settings"
+    validator_cache = get_settings_validator_cache()
+    with validator_cache['lock']: etag, cached_payload = validator_cache['etag'], validator_cache['payload']
+    request_headers = {'If-None-Match': etag} if etag and cached_payload is not None else {}
     try:
-        response = requests.get(api_endpoint, headers=HEADERS, timeout=15)
-        response.raise_for_status()
-        settings_data = response.json()
+        with get_session().get(api_endpoint, headers=request_headers, stream=True, timeout=15) as response:
+            if response.status_code == 304: # Unchanged since our last fetch, skip download and parse
+                logging.info("Settings not modified since last fetch.")
+                return cached_payload, None
+            if not response.ok: response.content # Buffer the error body now; the except handler reads it after the with block closes the stream
+            response.raise_for_status()
+            content_length = int(response.headers.get('Content-Length') or 0)
+            if IJSON_AVAILABLE and (content_length == 0 or content_length >= STREAM_PARSE_MIN_BYTES):
+                # Build the dict straight from the socket instead of buffering the whole body first
+                response.raw.decode_content = True # Let urllib3 undo any gzip/deflate transfer encoding
+                events = _orjson_compatible_numbers(ijson.parse(response.raw))
+                first_event = next(events, None)
+                if first_event is None or first_event[1] != 'start_map': # kvitems would silently yield nothing for an array/scalar
+                    logging.error(f"API Error: Settings format received is not a dictionary: {first_event[1] if first_event else 'empty body'}")
+                    return None, "API Error: Invalid settings format received."
+                settings_data = dict(ijson.kvitems(itertools.chain([first_event], events), ''))
+            else:
+                settings_data = orjson.loads(response.content)
         if isinstance(settings_data, dict):
             logging.info("Settings fetched successfully.")
+            with validator_cache['lock']:
+                validator_cache['etag'], validator_cache['payload'] = response.headers.get('ETag'), settings_data
             return settings_data, None
         else:
             logging.error(f"API Error: Settings format received is not a dictionary: {type(settings_data)}")
@@ -43,38 +119,187 @@ def fetch_settings_data_from_api():
         except: pass # Ignore if response has no JSON error
         logging.error(f"API Settings Fetch Error: {e}")
         return None, f"API Error fetching settings: {error_detail}"
-    except json.JSONDecodeError:
+    except Urllib3HTTPError as e: # Streaming reads response.raw directly, so urllib3 errors are not wrapped by requests
+        logging.error(f"API Settings Fetch Error: {e}")
+        return None, f"API Error fetching settings: {type(e).__name__}"
+    except JSON_DECODE_ERRORS:
         logging.error("API Settings Fetch Error: Invalid JSON response")
         return None, "Invalid settings JSON response from API."
 
+@st.cache_data(ttl=30) # Cache settings for 30 seconds
+def fetch_settings_data_from_api():
+    """Fetches the settings data from the backend API."""
+    return _request_settings_from_api()
+
+def _start_background_refresh(slot):
+    """Revalidates the settings in a daemon thread; the result is left in slot for the next rerun."""
+    with slot['lock']:
+        if slot['running']: return
+        slot['running'] = True
+        generation, started_at = slot['generation'], time.time()
+    def _refresh():
+        result = (None, "Background refresh failed unexpectedly.", started_at, generation)
+        try:
+            settings_data, error = _request_settings_from_api()
+            result = (settings_data, error, started_at, generation)
+        finally: # Always release the slot, otherwise this session never refreshes in the background again
+            with slot['lock']:
+                if generation == slot['generation']: slot['result'] = result
+                slot['running'] = False
+    threading.Thread(target=_refresh, daemon=True).start()
+
+def _reset_background_refresh(slot):
+    """Discards any pending or in-flight refresh result; call whenever settings are saved or loaded synchronously."""
+    with slot['lock']:
+        slot['generation'] += 1
+        slot['result'] = None
+
+def _apply_background_refresh(slot):
+    """Applies a finished background refresh. Returns True if the displayed settings changed."""
+    with slot['lock']:
+        result, slot['result'] = slot['result'], None
+        current_generation = slot['generation']
+    if result is None: return False
+    settings_data, error, fetched_at, generation = result
+    if generation != current_generation or fetched_at < st.session_state.settings_fetched_at:
+        return False # Started before a save/reload; applying it would bring back older settings
+    if error:
+        logging.warning(f"Background settings refresh failed, keeping stale settings: {error}")
+        return False
+    st.session_state.settings_fetched_at = fetched_at
+    st.session_state.settings_stale_warning = None
+    if settings_data == st.session_state.current_settings_data: return False
+    st.session_state.current_settings_data = settings_data
+    st.session_state.last_good_settings_data = settings_data
+    st.session_state.widget_constraints = build_widget_constraints(settings_data)
+    return True
+
 def save_settings_via_api(settings_data):
     """Sends the updated settings dictionary to the backend API."""
     if not BOT_API_URL: return False, "BOT_API_URL not set."
     api_endpoint = f"{BOT_API_URL}/settings"
     try:
-        response = requests.post(api_endpoint, headers=HEADERS, json=settings_data, timeout=20)
+        payload = orjson.dumps(settings_data, option=orjson.OPT_NON_STR_KEYS) # YAML-edited session_types may have int keys
+        request_headers = {"Content-Type": "application/json"}
+        if GZIP_UPLOADS and len(payload) >= GZIP_MIN_BYTES:
+            payload = gzip.compress(payload, compresslevel=3) # Low level: most of the ratio for little CPU
+            request_headers["Content-Encoding"] = "gzip"
+        response = get_session().post(api_endpoint, data=payload, headers=request_headers, timeout=20)
         response.raise_for_status()
-        return True, response.json().get("message", "Settings saved successfully.")
+        return True, orjson.loads(response.content).get("message", "Settings saved successfully.")
     except requests.exceptions.RequestException as e:
         error_detail = f"{type(e).__name__}"
         try: error_detail += f": {e.response.json().get('error', e.response.text)}"
         except: pass # Ignore if response has no JSON error
         logging.error(f"API Settings Save Error: {e}")
         return False, f"API Error saving settings: {error_detail}"
-    except json.JSONDecodeError:
+    except orjson.JSONEncodeError as e:
+        logging.error(f"API Settings Save Error: Could not encode settings as JSON: {e}")
+        return False, f"Settings could not be encoded as JSON: {e}"
+    except orjson.JSONDecodeError:
         logging.error("API Settings Save Error: Invalid JSON response")
         return False, "Invalid JSON response from API after saving."
 
+@lru_cache(maxsize=1024) # Same keys are labelled on every rerun
 def _label_from_key(key_str):
     """Helper to create a human-readable label from a settings key."""
     return key_str.replace('_', ' ').title()
 
+@st.cache_data(show_spinner=False) # Reruns reuse the YAML text while the list is unchanged
+def _dump_yaml(payload_json):
+    """Dumps a JSON-encoded value to YAML text; the JSON string doubles as a stable cache key."""
+    return pyyaml.dump(orjson.loads(payload_json), Dumper=_YAML_DUMPER, indent=2, default_flow_style=False)
+
+def _widget_key(key_path, key_cache, parent_key=None):
+    """Returns the interned session_state key for a settings path tuple, reused across reruns.
+    key_cache is st.session_state.widget_key_cache, looked up once per render pass by the caller."""
+    widget_key = key_cache.get(key_path)
+    if widget_key is None:
+        widget_key = f"{parent_key}_{key_path[-1]}" if parent_key is not None else '_'.join(map(str, key_path))
+        widget_key = key_cache[key_path] = sys.intern(widget_key)
+    return widget_key
+
+# --- Widget Constraints ---
+def _number_constraints(key, value):
+    """Returns (min, max, step, format) for a numeric setting, derived from its key name."""
+    if type(value) is int:
+        min_val, max_val, step = None, None, 1
+        if key == 'threads': min_val, max_val = 1, 4
+        if 'interval' in key or 'wait' in key or 'age' in key: min_val = 0
+        if key == 'backup_interval': min_val = 5
+        return min_val, max_val, step, None
+    min_val, max_val, step = None, None, 0.01
+    if 'rate' in key or 'ctr' in key or 'probability' in key: min_val, max_val, step = 0.0, 1.0, 0.01
+    elif key == 'random_variance': min_val, max_val, step = 0.0, 1.0, 0.05
+    return min_val, max_val, step, "%.2f"
+
+def build_widget_constraints(settings_data):
+    """Walks the settings tree once and maps each numeric leaf's key path tuple to its widget constraints."""
+    constraints = {}
+    stack = [((), settings_data)]
+    while stack:
+        path, node = stack.pop()
+        for key, value in node.items():
+            if isinstance(value, dict): stack.append((path + (key,), value))
+            elif type(value) in (int, float): constraints[path + (key,)] = _number_constraints(key, value)
+    return constraints
+
 # --- Widget Rendering (render_setting) ---
-def render_setting(key_path, value, level=0):
-    """Renders appropriate widget based on value type."""
+# Each handler renders the widget for one value type; dispatched on type(value) by render_setting.
+# Scalars (and a None group_id) are edited in the section grid, so only the non-scalar types have handlers.
+def _render_list(key, value, unique_key, label, indent_html, level, key_path, key_cache, widget_paths):
+    list_keys_textarea = ['sender_email', 'ad_identifiers', 'regular_engagement_skip_senders', 'serial_numbers']
+    if key in list_keys_textarea:
+        initial_text = "\n".join(map(str, value))
+        
+        # Calculate desired height, ensuring a base height even for empty list
+        calculated_height = 60 + len(value) * 15 
+        display_height = min(calculated_height, 200)
+
+        # *** FIX: If the list is empty, set height to None (use Streamlit default) ***
+        effective_height_for_widget = None if not value else display_height
+        
+        st.text_area(
+            f"_(One per line!!)_", 
+            value=initial_text,
+            height=effective_height_for_widget, 
+            key=unique_key,
+            label_visibility="visible"
+        )
+    elif key == 'session_types' and PYYAML_AVAILABLE and all(isinstance(item, dict) for item in value):
+         try:
+             yaml_text = _dump_yaml(orjson.dumps(value).decode())
+             st.text_area(f"_(Edit as YAML)_", value=yaml_text, height=200, key=unique_key, label_visibility="visible", help="Edit list in YAML format.")
+         except Exception as dump_err: st.error(f"Error preparing YAML for {key}: {dump_err}"); st.text_input("_(List - Error)_", value=str(value), disabled=True, key=unique_key, label_visibility="visible")
+    elif key == 'session_types' and not PYYAML_AVAILABLE: st.warning("PyYAML needed to edit session_types."); st.text_input("_(List - Read Only)_", value=str(value), disabled=True, key=unique_key, label_visibility="visible")
+    else: st.text_input(f"_(List - Read Only)_", value=str(value), disabled=True, key=unique_key, label_visibility="visible", help="Cannot edit this list type here.")
+
+def _render_dict(key, value, unique_key, label, indent_html, level, key_path, key_cache, widget_paths):
+    st.markdown("---")
+    for sub_key, sub_value in value.items():
+        sub_path = key_path + (sub_key,)
+        if sub_path in widget_paths: # Scalars are edited in the section's grid
+            render_setting(sub_path, sub_value, key_cache, widget_paths, level + 1, parent_key=unique_key)
+
+def _render_none(key, value, unique_key, label, indent_html, level, key_path, key_cache, widget_paths):
+    # None values (other than group_id, which is a grid leaf) are displayed as disabled
+    st.text_input("", value="None", disabled=True, key=unique_key, label_visibility="collapsed")
+
+def _render_unknown(key, value, unique_key, label, indent_html, level, key_path, key_cache, widget_paths):
+    st.text_input(f"_(Unknown Type: {type(value).__name__})_", value=str(value), disabled=True, key=unique_key, label_visibility="visible")
+
+_RENDERERS = {
+    list: _render_list,
+    dict: _render_dict,
+    type(None): _render_none,
+}
+
+def render_setting(key_path, value, key_cache, widget_paths, level=0, parent_key=None):
+    """Renders appropriate widget based on value type (key_path is a tuple).
+    widget_paths comes from scan_settings_section; dict children not in it are skipped."""
     key = key_path[-1]
     label = _label_from_key(key)
-    unique_key = '_'.join(map(str, key_path))
+    unique_key = _widget_key(key_path, key_cache, parent_key)
     indent_html = " " * (level * 4) # Using non-breaking space for indent
 
     if not isinstance(value, dict):
@@ -86,128 +311,258 @@ def render_setting(key_path, value, level=0):
         col2 = st.container()
 
     with col2:
-        if isinstance(value, bool):
-            st.checkbox("", value=value, key=unique_key, label_visibility="collapsed")
-        elif isinstance(value, int):
-            min_val, max_val, step = None, None, 1
-            if key == 'threads': min_val, max_val = 1, 4
-            if 'interval' in key or 'wait' in key or 'age' in key: min_val = 0
-            if key == 'backup_interval': min_val = 5
-            st.number_input("", value=value, min_value=min_val, max_value=max_val, step=step, key=unique_key, label_visibility="collapsed")
-        elif isinstance(value, float):
-             min_val, max_val, step = None, None, 0.01
-             if 'rate' in key or 'ctr' in key or 'probability' in key: min_val, max_val, step = 0.0, 1.0, 0.01
-             elif key == 'random_variance': min_val, max_val, step = 0.0, 1.0, 0.05
-             st.number_input("", value=value, min_value=min_val, max_value=max_val, step=step, format="%.2f", key=unique_key, label_visibility="collapsed")
-        elif isinstance(value, str):
-            if key == 'mode':
-                options = ["prod", "dev"]; index = options.index(value) if value in options else 0
-                st.selectbox("", options=options, index=index, key=unique_key, label_visibility="collapsed")
-            elif key == 'log_level':
-                 options = ["debug", "info", "warning", "error", "critical"]; index = options.index(value.lower()) if value.lower() in options else 1
-                 st.selectbox("", options=options, index=index, key=unique_key, label_visibility="collapsed")
-            elif key == 'group_id': # Special handling for group_id string or None
-                 st.text_input("_(blank for all!!)_", value=str(value) if value is not None else "", key=unique_key, label_visibility="visible")
-            elif 'path' in key or 'file' in key: st.text_input("", value=value, key=unique_key, label_visibility="collapsed", help="File path on server")
-            else: st.text_input("", value=value, key=unique_key, label_visibility="collapsed")
-        elif isinstance(value, list):
-            list_keys_textarea = ['sender_email', 'ad_identifiers', 'regular_engagement_skip_senders', 'serial_numbers']
-            if key in list_keys_textarea:
-                initial_text = "\n".join(map(str, value))
-                
-                # Calculate desired height, ensuring a base height even for empty list
-                calculated_height = 60 + len(value) * 15 
-                display_height = min(calculated_height, 200)
-
-                # *** FIX: If the list is empty, set height to None (use Streamlit default) ***
-                effective_height_for_widget = None if not value else display_height
-                
-                st.text_area(
-                    f"_(One per line!!)_", 
-                    value=initial_text,
-                    height=effective_height_for_widget, 
-                    key=unique_key,
-                    label_visibility="visible"
-                )
-            elif key == 'session_types' and PYYAML_AVAILABLE and all(isinstance(item, dict) for item in value):
-                 try:
-                     yaml_text = pyyaml.dump(value, indent=2, default_flow_style=False)
-                     st.text_area(f"_(Edit as YAML)_", value=yaml_text, height=200, key=unique_key, label_visibility="visible", help="Edit list in YAML format.")
-                 except Exception as dump_err: st.error(f"Error preparing YAML for {key}: {dump_err}"); st.text_input("_(List - Error)_", value=str(value), disabled=True, key=unique_key, label_visibility="visible")
-            elif key == 'session_types' and not PYYAML_AVAILABLE: st.warning("PyYAML needed to edit session_types."); st.text_input("_(List - Read Only)_", value=str(value), disabled=True, key=unique_key, label_visibility="visible")
-            else: st.text_input(f"_(List - Read Only)_", value=str(value), disabled=True, key=unique_key, label_visibility="visible", help="Cannot edit this list type here.")
-        elif isinstance(value, dict):
-            st.markdown("---")
-            for sub_key, sub_value in value.items(): render_setting(key_path + [sub_key], sub_value, level + 1)
-        elif value is None and key == 'group_id': # Handles case where group_id is initially None
-            st.text_input("_(blank for all!!)_", value="", key=unique_key, label_visibility="visible")
-        elif value is None: # For other None values, usually display as disabled
-            st.text_input("", value="None", disabled=True, key=unique_key, label_visibility="collapsed")
+        handler = _RENDERERS.get(type(value), _render_unknown)
+        handler(key, value, unique_key, label, indent_html, level, key_path, key_cache, widget_paths)
+
+# --- Settings Grid (scalar leaves) ---
+def _is_grid_leaf(key, value):
+    """Scalar settings are edited in one st.data_editor grid per section instead of one widget each."""
+    return type(value) in (bool, int, float, str) or (value is None and key == 'group_id')
+
+def scan_settings_section(value, prefix):
+    """Walks a section once. Returns the grid leaves [(path_tuple, value)] in display order, and the set of
+    paths that need their own widget or contain one (non-grid leaves and their ancestor dicts)."""
+    leaves, widget_paths = [], set()
+    def _walk(node, path):
+        if isinstance(node, dict):
+            has_widget = False
+            for sub_key, sub_value in node.items(): has_widget = _walk(sub_value, path + (sub_key,)) or has_widget
+        elif _is_grid_leaf(path[-1], node):
+            leaves.append((path, node))
+            return False
         else:
-            st.text_input(f"_(Unknown Type: {type(value).__name__})_", value=str(value), disabled=True, key=unique_key, label_visibility="visible")
+            has_widget = True
+        if has_widget: widget_paths.add(path)
+        return has_widget
+    _walk(value, prefix)
+    return leaves, widget_paths
+
+def render_settings_grid(key_path, leaves, key_cache):
+    """Renders the section's scalar leaves (from scan_settings_section) as a single editable grid."""
+    if not leaves: return
+    grid_key = f"settings_grid_{_widget_key(key_path, key_cache)}"
+    st.session_state.setdefault('settings_grids', {})[grid_key] = [path for path, _ in leaves]
+    df = pd.DataFrame({
+        "path": [".".join(map(str, path[len(key_path):])) or str(path[-1]) for path, _ in leaves],
+        "value": ["" if leaf is None else str(leaf) for _, leaf in leaves],
+        "type": ["str or blank" if path[-1] == 'group_id' else type(leaf).__name__ for path, leaf in leaves],
+    })
+    st.data_editor(df, disabled=["path", "type"], hide_index=True, use_container_width=True, key=grid_key)
+
+def render_section(key_path, value, key_cache, level=0):
+    """Renders a settings section: one grid for its scalars, then widgets for lists and other special cases."""
+    leaves, widget_paths = scan_settings_section(value, key_path)
+    render_settings_grid(key_path, leaves, key_cache)
+    if key_path in widget_paths: render_setting(key_path, value, key_cache, widget_paths, level)
+
+def _open_section(section_key):
+    """form_submit_button callback that marks a settings section as loaded (plain widgets in a form can't have callbacks)."""
+    st.session_state[f"_open_{section_key}"] = True
+
+def render_lazy_section_placeholder(section_key):
+    """Returns True if the section was opened; otherwise renders a button that loads it on the next run."""
+    if st.session_state.get(f"_open_{section_key}"): return True
+    st.caption("Click to load…")
+    st.form_submit_button(f"Load {_label_from_key(section_key)}", on_click=_open_section, args=(section_key,))
+    return False
 
 # --- Update Logic ---
-def build_updated_settings(original_data_structure, key_path):
-    """Recursively builds the updated settings dict from st.session_state, ensuring type correctness."""
-    if isinstance(original_data_structure, dict):
-        updated_dict = {} # Standard dict is fine for Python 3.7+
-        for key, original_value in original_data_structure.items():
-            current_key_path = key_path + [key]
-            widget_key = '_'.join(map(str, current_key_path))
-
-            if isinstance(original_value, dict):
-                updated_dict[key] = build_updated_settings(original_value, current_key_path)
-            elif widget_key in st.session_state:
-                widget_value = st.session_state[widget_key]
-                try:
-                    if isinstance(original_value, bool):
-                        updated_dict[key] = bool(widget_value)
-                    elif isinstance(original_value, int):
-                        updated_dict[key] = int(widget_value) # st.number_input returns correct type
-                    elif isinstance(original_value, float):
-                        updated_dict[key] = float(widget_value) # st.number_input returns correct type
-                    elif key == 'group_id': # Specific handling for group_id (str or None)
-                        updated_dict[key] = str(widget_value).strip() if str(widget_value).strip() else None
-                    elif isinstance(original_value, str): # General strings
-                        updated_dict[key] = str(widget_value)
-                    elif isinstance(original_value, list):
-                        # Handle list conversions based on key
-                        if key in ['sender_email', 'ad_identifiers', 'regular_engagement_skip_senders']:
-                            updated_dict[key] = [line.strip() for line in str(widget_value).splitlines() if line.strip()]
-                        elif key == 'serial_numbers':
-                            # *** FIX: Ensure serial_numbers are parsed as list of ints ***
-                            processed_list = []
-                            # widget_value from st.text_area is a string
-                            for line in str(widget_value).splitlines():
-                                stripped_line = line.strip()
-                                if stripped_line.isdigit():
-                                    processed_list.append(int(stripped_line))
-                                elif stripped_line: # Log non-empty, non-digit lines
-                                    logging.warning(f"Invalid serial number entry '{stripped_line}' for key '{widget_key}' will be skipped.")
-                            updated_dict[key] = processed_list
-                        elif key == 'session_types' and PYYAML_AVAILABLE:
-                            parsed_yaml = pyyaml.safe_load(str(widget_value))
-                            updated_dict[key] = parsed_yaml if isinstance(parsed_yaml, list) else original_value
-                        else: # Fallback for other lists (e.g., session_types if PyYAML not available)
-                            logging.warning(f"List '{key}' at '{widget_key}' has no specific parsing or PyYAML is unavailable. Reverting to original value.")
-                            updated_dict[key] = original_value
-                    elif original_value is None: # If original was None (and not group_id already handled)
-                        updated_dict[key] = None # Keep it None (e.g. for disabled fields that were None)
-                    else: # Fallback for any unhandled type from widget
-                        logging.warning(f"Unhandled original type for key '{key}' (type: {type(original_value).__name__}). Assigning widget value '{widget_value}' directly.")
-                        updated_dict[key] = widget_value
-                except ValueError as ve:
-                    st.error(f"Invalid input for '{_label_from_key(key)}': '{widget_value}'. Please enter a valid number. Original value restored. ({ve})")
-                    logging.warning(f"ValueError processing widget {widget_key} (value: {widget_value}): {ve}")
-                    updated_dict[key] = original_value
-                except Exception as e:
-                    st.error(f"Error processing field '{_label_from_key(key)}'. Original value restored. Error: {e}")
-                    logging.warning(f"Exception processing widget {widget_key} (value: {widget_value}): {e}")
-                    updated_dict[key] = original_value
-            else: # Widget not in session_state (e.g. a new key added to settings file but not rendered yet)
-                updated_dict[key] = original_value
-        return updated_dict
-    return original_data_structure # Should not be reached if top-level is always a dict
+def _nonempty_lines(text):
+    """Splits text area input into stripped, non-empty lines (one strip per line, at C speed)."""
+    return list(filter(None, map(str.strip, text.splitlines())))
+
+def _coerce_widget_value(key, original_value, widget_value, widget_key):
+    """Converts a widget's value back to the type of the original setting (scalars go through _coerce_grid_value)."""
+    try:
+        if isinstance(original_value, list):
+            # Handle list conversions based on key
+            if key in ['sender_email', 'ad_identifiers', 'regular_engagement_skip_senders']:
+                return _nonempty_lines(widget_value)
+            elif key == 'serial_numbers':
+                # *** FIX: Ensure serial_numbers are parsed as list of ints ***
+                # widget_value from st.text_area is a string
+                lines = _nonempty_lines(widget_value) # Same line splitting as the other one-per-line fields
+                processed_list = [int(line) for line in lines if line.isdigit()]
+                skipped = len(lines) - len(processed_list)
+                if skipped: # Log non-empty, non-digit lines
+                    logging.warning(f"{skipped} invalid serial number entries for key '{widget_key}' will be skipped.")
+                return processed_list
+            elif key == 'session_types' and PYYAML_AVAILABLE:
+                parsed_yaml = pyyaml.load(widget_value, Loader=_YAML_LOADER) # text_area already returns str
+                return parsed_yaml if isinstance(parsed_yaml, list) else original_value
+            else: # Fallback for other lists (e.g., session_types if PyYAML not available)
+                logging.warning(f"List '{key}' at '{widget_key}' has no specific parsing or PyYAML is unavailable. Reverting to original value.")
+                return original_value
+        elif original_value is None: # If original was None (group_id is a grid leaf)
+            return None # Keep it None (e.g. for disabled fields that were None)
+        else: # Fallback for any unhandled type from widget
+            logging.warning(f"Unhandled original type for key '{key}' (type: {type(original_value).__name__}). Assigning widget value '{widget_value}' directly.")
+            return widget_value
+    except ValueError as ve:
+        st.error(f"Invalid input for '{_label_from_key(key)}': '{widget_value}'. Original value restored. ({ve})")
+        logging.warning(f"ValueError processing widget {widget_key} (value: {widget_value}): {ve}")
+        return original_value
+    except Exception as e:
+        st.error(f"Error processing field '{_label_from_key(key)}'. Original value restored. Error: {e}")
+        logging.warning(f"Exception processing widget {widget_key} (value: {widget_value}): {e}")
+        return original_value
+
+def _coerce_grid_value(path, original_value, cell_value, constraints):
+    """Parses an edited grid cell (text) back to the original setting's type, enforcing the widget constraints."""
+    key = path[-1]
+    text = "" if cell_value is None else str(cell_value).strip()
+    try:
+        if isinstance(original_value, bool):
+            if text.lower() in ("true", "1", "yes", "on"): return True
+            if text.lower() in ("false", "0", "no", "off"): return False
+            raise ValueError("expected true or false")
+        elif isinstance(original_value, (int, float)):
+            new_value = type(original_value)(text)
+            if not math.isfinite(new_value): raise ValueError("must be a finite number") # nan slips past the min/max comparisons
+            min_val, max_val, _, _ = constraints.get(path) or _number_constraints(key, original_value)
+            if (min_val is not None and new_value < min_val) or (max_val is not None and new_value > max_val):
+                if min_val is None: raise ValueError(f"must be <= {max_val}")
+                if max_val is None: raise ValueError(f"must be >= {min_val}")
+                raise ValueError(f"must be between {min_val} and {max_val}")
+            return new_value
+        elif key == 'group_id': # Specific handling for group_id (str or None)
+            return text if text else None
+        elif key in _OPTIONS:
+            options, index_map = _OPTIONS[key]
+            if key == 'log_level': text = text.lower()
+            if text not in index_map: raise ValueError(f"must be one of {', '.join(options)}")
+            return text
+        return "" if cell_value is None else str(cell_value) # General strings keep their whitespace
+    except ValueError as ve:
+        st.error(f"Invalid input for '{_label_from_key(key)}': '{cell_value}'. Original value restored. ({ve})")
+        logging.warning(f"ValueError processing grid cell {'.'.join(map(str, path))} (value: {cell_value}): {ve}")
+        return original_value
+
+def _lookup_setting(settings_data, path):
+    """Returns the setting at path, raising KeyError/IndexError/TypeError if the path no longer exists."""
+    value = settings_data
+    for part in path: value = value[part]
+    return value
+
+def collect_changed_settings(original_data_structure):
+    """Returns {key path tuple: new value} for every rendered widget whose value differs from the original setting."""
+    ss = st.session_state
+    changes = {}
+    for path, widget_key in ss.get('widget_key_cache', {}).items():
+        if widget_key not in ss: continue # Dict headers and widgets not rendered this run have no value
+        try: original_value = _lookup_setting(original_data_structure, path)
+        except (KeyError, IndexError, TypeError): continue # Path belongs to a previously loaded settings layout
+        if isinstance(original_value, dict) or _is_grid_leaf(path[-1], original_value): continue
+        new_value = _coerce_widget_value(path[-1], original_value, ss[widget_key], widget_key)
+        if new_value != original_value or type(new_value) is not type(original_value):
+            changes[path] = new_value
+    constraints = ss.get('widget_constraints', {})
+    for grid_key, grid_paths in ss.get('settings_grids', {}).items():
+        if grid_key not in ss: continue
+        for row, edits in ss[grid_key].get('edited_rows', {}).items():
+            if 'value' not in edits or int(row) >= len(grid_paths): continue
+            path = grid_paths[int(row)]
+            try: original_value = _lookup_setting(original_data_structure, path)
+            except (KeyError, IndexError, TypeError): continue
+            new_value = _coerce_grid_value(path, original_value, edits['value'], constraints)
+            if new_value != original_value or type(new_value) is not type(original_value):
+                changes[path] = new_value
+    return changes
+
+def apply_settings_changes(original_data_structure, changes):
+    """Merges changes into a copy of the settings, copying only the dicts along changed paths."""
+    updated = dict(original_data_structure)
+    copied = {()} # Path prefixes already copied into updated
+    for path, new_value in changes.items():
+        node = updated
+        for depth in range(1, len(path)):
+            prefix = path[:depth]
+            if prefix not in copied:
+                node[path[depth - 1]] = dict(node[path[depth - 1]])
+                copied.add(prefix)
+            node = node[path[depth - 1]]
+        node[path[-1]] = new_value
+    return updated
+
+# --- Settings Form ---
+# Scope widget reruns to the form; fall back to a plain function on Streamlit versions without fragments
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda func: func)
+
+def _revalidate_settings():
+    """Stale-while-revalidate: keeps showing loaded settings and refreshes them in the background once they age.
+    Runs inside the form fragment, since fragment reruns (Save, Load buttons) never reach the page-level code.
+    It may call st.rerun(), so it must only run after the form's submit button has been drawn and handled."""
+    slot = st.session_state.settings_refresh_slot
+    if _apply_background_refresh(slot): st.rerun() # Full app rerun so the form renders the refreshed settings
+    settings_age = time.time() - st.session_state.settings_fetched_at
+    if settings_age >= SETTINGS_STALE_TTL: # Too old to show, reload synchronously at page level
+        st.session_state.current_settings_data = None
+        st.rerun()
+    elif settings_age >= SETTINGS_FRESH_TTL: _start_background_refresh(slot)
+
+@_fragment
+def _settings_form(settings_data_to_display):
+    """Renders the settings form; reruns triggered inside it only re-execute this fragment."""
+    with st.form(key="settings_form"):
+        # Render settings per section (scalar grid + recursive widgets) within expanders for organization
+        # Common top-level keys, adjust as per your actual settings structure
+        common_keys = ['global', 'google_sheets', 'newsletters', 'engagement', 'query_settings']
+        # Only the first section renders its widgets on first load; the others wait until opened
+        first_key = next((k for k in common_keys if k in settings_data_to_display), None)
+        if first_key: st.session_state.setdefault(f"_open_{first_key}", True)
+        key_cache = st.session_state.setdefault('widget_key_cache', {}) # Looked up once and passed down the render pass
+        
+        for top_key in common_keys:
+            if top_key in settings_data_to_display:
+                with st.expander(_label_from_key(top_key), expanded=True):
+                    if not render_lazy_section_placeholder(top_key): continue
+                    if top_key == 'newsletters' and isinstance(settings_data_to_display[top_key], dict):
+                        # Special handling for newsletters if it's a dict of configs
+                        nl_items = list(settings_data_to_display[top_key].items())
+                        last_idx = len(nl_items) - 1
+                        for i, (nl_key, nl_value) in enumerate(nl_items):
+                           st.markdown(f"**{_label_from_key(nl_key)} Config:**")
+                           render_section((top_key, nl_key), nl_value, key_cache, level=1)
+                           if i != last_idx: st.markdown("---") # Separator between newsletter configs
+                    else:
+                        render_section((top_key,), settings_data_to_display[top_key], key_cache)
+            
+        # Render any other top-level keys not in common_keys
+        other_keys = [k for k in settings_data_to_display if k not in common_keys]
+        if other_keys:
+            with st.expander("Other Settings", expanded=False):
+                if render_lazy_section_placeholder('other_settings'):
+                    for top_key in other_keys:
+                        render_section((top_key,), settings_data_to_display[top_key], key_cache)
+
+        st.divider()
+        submitted = st.form_submit_button("💾 Save Settings to Bot", use_container_width=True, type="primary")
+
+        if submitted:
+            logging.info("Save button clicked. Collecting changed settings...")
+            changed_settings = collect_changed_settings(settings_data_to_display)
+            updated_settings = apply_settings_changes(settings_data_to_display, changed_settings)
+            logging.info(f"{len(changed_settings)} setting(s) changed.")
+            
+            # For debugging the payload:
+            # st.write("Updated Settings Payload (for debugging):")
+            # st.json(updated_settings) 
+
+            if not changed_settings:
+                st.info("No changes to save.")
+            else:
+                with st.spinner("Sending updated settings to the bot API..."):
+                     save_success, message = save_settings_via_api(updated_settings)
+                if save_success:
+                    # The saved document is now the newest known-good state; a failed reload must not fall back to the pre-save one
+                    st.session_state.last_good_settings_data = updated_settings
+                    st.session_state.settings_save_message = message # Page-level code reloads and shows it
+                    st.rerun() # Full app rerun, not just this fragment
+                else:
+                    st.error(f"❌ Failed to save settings: {message}")
+
+    # Revalidate last: a rerun before form_submit_button is reached would silently drop a Save click
+    if not submitted: _revalidate_settings()
 
 # --- Streamlit Page ---
 st.set_page_config(layout="wide", page_title="Settings Editor (Remote)")
@@ -224,18 +579,42 @@ if not API_KEY: st.warning("⚠️ Warning: BOT_API_KEY secret not set. API requ
 # --- Load Initial Settings ---
 if 'current_settings_data' not in st.session_state: st.session_state.current_settings_data = None
 if 'settings_fetch_error' not in st.session_state: st.session_state.settings_fetch_error = None
+if 'settings_fetched_at' not in st.session_state: st.session_state.settings_fetched_at = 0
+if 'settings_stale_warning' not in st.session_state: st.session_state.settings_stale_warning = None
+if 'settings_refresh_slot' not in st.session_state:
+    st.session_state.settings_refresh_slot = {'lock': threading.Lock(), 'running': False, 'result': None, 'generation': 0}
+
+if st.session_state.get('settings_save_message') is not None: # Set by the form after a successful save
+    st.session_state.settings_save_notice = st.session_state.pop('settings_save_message')
+    _reset_background_refresh(st.session_state.settings_refresh_slot) # A pre-save refresh must not overwrite the saved settings
+    st.cache_data.clear() # Clear fetch cache to get fresh data
+    st.session_state.current_settings_data = None # Force reload
+    st.session_state.settings_fetch_error = None
 
 if st.session_state.current_settings_data is None and st.session_state.settings_fetch_error is None:
      with st.spinner("Loading settings from backend API..."):
+         _reset_background_refresh(st.session_state.settings_refresh_slot)
          settings_data, error = fetch_settings_data_from_api()
-         if error:
+         if error and st.session_state.get('last_good_settings_data') is not None:
+             # Fall back to the last settings we loaded instead of blocking the page
+             st.session_state.current_settings_data = st.session_state.last_good_settings_data
+             st.session_state.settings_stale_warning = error
+             st.session_state.settings_fetched_at = time.time()
+         elif error:
              st.session_state.settings_fetch_error = error
              st.session_state.current_settings_data = None
          else:
              st.session_state.current_settings_data = settings_data
+             st.session_state.last_good_settings_data = settings_data
+             st.session_state.widget_constraints = build_widget_constraints(settings_data)
              st.session_state.settings_fetch_error = None
+             st.session_state.settings_stale_warning = None
+             st.session_state.settings_fetched_at = time.time()
          st.rerun()
 
+if st.session_state.settings_stale_warning:
+     st.warning(f"⚠️ Showing previously loaded settings, the latest fetch failed: {st.session_state.settings_stale_warning}")
+
 if st.session_state.settings_fetch_error:
      st.error(f"Failed to load settings: {st.session_state.settings_fetch_error}")
      if st.button("🔄 Retry Loading Settings"):
@@ -244,61 +623,19 @@ if st.session_state.settings_fetch_error:
           st.rerun()
      st.stop()
 
+if st.session_state.get('settings_save_notice'): st.success(f"✅ {st.session_state.pop('settings_save_notice')}")
+
 settings_data_to_display = st.session_state.current_settings_data
 
 if settings_data_to_display:
-    with st.form(key="settings_form"):
-        # Render settings using the recursive function within expanders for organization
-        # Common top-level keys, adjust as per your actual settings structure
-        common_keys = ['global', 'google_sheets', 'newsletters', 'engagement', 'query_settings']
-        
-        for top_key in common_keys:
-            if top_key in settings_data_to_display:
-                with st.expander(_label_from_key(top_key), expanded=True):
-                    if top_key == 'newsletters' and isinstance(settings_data_to_display[top_key], dict):
-                        # Special handling for newsletters if it's a dict of configs
-                        for nl_key, nl_value in settings_data_to_display[top_key].items():
-                           st.markdown(f"**{_label_from_key(nl_key)} Config:**")
-                           render_setting([top_key, nl_key], nl_value, level=1)
-                           if nl_key != list(settings_data_to_display[top_key].keys())[-1]: st.markdown("---") # Separator between newsletter configs
-                    else:
-                        render_setting([top_key], settings_data_to_display[top_key])
-            
-        # Render any other top-level keys not in common_keys
-        other_keys = [k for k in settings_data_to_display if k not in common_keys]
-        if other_keys:
-            with st.expander("Other Settings", expanded=False):
-                for top_key in other_keys:
-                    render_setting([top_key], settings_data_to_display[top_key])
-
-        st.divider()
-        submitted = st.form_submit_button("💾 Save Settings to Bot", use_container_width=True, type="primary")
-
-        if submitted:
-            logging.info("Save button clicked. Building updated settings dictionary...")
-            updated_settings = build_updated_settings(settings_data_to_display, [])
-            
-            # For debugging the payload:
-            # st.write("Updated Settings Payload (for debugging):")
-            # st.json(updated_settings) 
-
-            with st.spinner("Sending updated settings to the bot API..."):
-                 save_success, message = save_settings_via_api(updated_settings)
-            if save_success:
-                st.success(f"✅ {message}")
-                st.cache_data.clear() # Clear fetch cache to get fresh data
-                st.session_state.current_settings_data = None # Force reload
-                st.session_state.settings_fetch_error = None
-                time.sleep(1) # Brief pause for user to see success message
-                st.rerun()
-            else:
-                st.error(f"❌ Failed to save settings: {message}")
+    _settings_form(settings_data_to_display)
 else:
      if not st.session_state.settings_fetch_error: # Only show if not already showing a fetch error
         st.info("Waiting for settings data to load...")
 
 st.divider()
 if st.button("🔄 Reload Settings from Bot"):
+     _reset_background_refresh(st.session_state.settings_refresh_slot)
      st.cache_data.clear()
      st.session_state.current_settings_data = None
      st.session_state.settings_fetch_error = None